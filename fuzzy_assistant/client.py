@@ -0,0 +1,49 @@
+import os
+import socket
+import sys
+import tempfile
+
+# Thin client for server.py. Forwards the command over a Unix socket so the
+# heavy imports and the entity cache stay warm in the server process.
+# Falls back to running script.py directly when the server isn't running.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def get_socket_path():
+    """Per-user socket path, preferring the XDG runtime dir when it exists"""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or f"/run/user/{os.getuid()}"
+    if os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, 'fuzzy_assistant.sock')
+    return os.path.join(tempfile.gettempdir(), f"fuzzy_assistant-{os.getuid()}.sock")
+
+SOCKET_PATH = get_socket_path()
+
+def send_command(command: str) -> tuple[int, str]:
+    """Send a command to the server and return its (exit status, output)"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(SOCKET_PATH)
+        sock.sendall(command.encode('utf-8') + b"\n")
+        sock.shutdown(socket.SHUT_WR)
+        response = b""
+        while chunk := sock.recv(65536):
+            response += chunk
+
+    status, _, output = response.decode('utf-8').partition("\n")
+    return int(status), output
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(1)
+
+    try:
+        status, output = send_command(" ".join(sys.argv[1:]))
+    except (FileNotFoundError, ConnectionRefusedError):
+        # No server running, run the command in a fresh interpreter instead
+        script_path = os.path.join(SCRIPT_DIR, 'script.py')
+        os.execv(sys.executable, [sys.executable, script_path, *sys.argv[1:]])
+
+    sys.stdout.write(output)
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
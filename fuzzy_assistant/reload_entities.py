@@ -1,5 +1,10 @@
 import requests
 import yaml
+try:
+    from yaml import CSafeDumper as SafeDumper  # LibYAML-backed, much faster when available
+except ImportError:
+    from yaml import SafeDumper
+import pickle
 import os
 import sys
 
@@ -14,25 +19,14 @@ HEADERS = {
     "content-type": "application/json",
 }
 
-# Debug configuration
-DEBUG = False
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-DEBUG_FILE = os.path.join(SCRIPT_DIR, '.debug_state')
+# Debug configuration, shared with script.py through the FUZZY_DEBUG environment variable
+DEBUG = os.environ.get('FUZZY_DEBUG', '0') == '1'
 
 def debug_print(*args, **kwargs):
     """Print debug messages only if DEBUG is True"""
     if DEBUG:
         print("Debug -", *args, **kwargs)
 
-def load_debug_state():
-    """Load debug state from file"""
-    global DEBUG
-    try:
-        with open(DEBUG_FILE, 'r') as f:
-            DEBUG = f.read().strip().lower() == 'true'
-    except FileNotFoundError:
-        pass
-
 def reload_entities():
     """Rescan and reload entities from Home Assistant"""
     try:
@@ -82,7 +76,15 @@ def reload_entities():
         
         # Save to YAML file
         with open('entities.yaml', 'w') as file:
-            yaml.dump(entity_dict, file, sort_keys=True)
+            yaml.dump(entity_dict, file, Dumper=SafeDumper, sort_keys=True)
+
+        # Save a pickled copy so script.py can skip YAML parsing on startup
+        with open('entities.pkl', 'wb') as file:
+            pickle.dump(entity_dict, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # Save the word trie used to prefilter fuzzy matching candidates
+        with open('entities_index.pkl', 'wb') as file:
+            pickle.dump(create_entity_index(entity_dict), file, protocol=pickle.HIGHEST_PROTOCOL)
             
         print("Entities reloaded successfully")
         return True
@@ -91,24 +93,31 @@ def reload_entities():
         print(f"Error reloading entities: {e}")
         return False
 
+# Key holding the entity_ids of the word that ends at a trie node
+TRIE_IDS_KEY = '_entity_ids'
+
 def create_entity_index(entities):
-    """Create search-optimized index of entity names"""
-    name_index = {}
+    """Create a character trie of entity name words for prefix candidate lookup"""
+    trie = {}
+
+    def insert(word, entity_id):
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node.setdefault(TRIE_IDS_KEY, set()).add(entity_id)
+
     for name, data in entities.items():
         words = name.lower().split()
         for word in words:
-            if word not in name_index:
-                name_index[word] = set()
-            name_index[word].add(data['entity_id'])
+            insert(word, data['entity_id'])
             # Add common abbreviations
             if word == "coffee":
-                name_index["cff"] = name_index[word]
-                name_index["cof"] = name_index[word]
-    return name_index
+                insert("cff", data['entity_id'])
+                insert("cof", data['entity_id'])
+    return trie
 
 def main():
     """Main function to reload entities"""
-    load_debug_state()
     return reload_entities()
 
 if __name__ == "__main__":
@@ -1,10 +1,27 @@
 import requests
+from requests.adapters import HTTPAdapter
 import yaml
-from thefuzz import fuzz
+try:
+    from yaml import CSafeLoader as SafeLoader  # LibYAML-backed, much faster when available
+except ImportError:
+    from yaml import SafeLoader
+import numpy as np
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
 import sys
 import re
 import os
 import time
+import pickle
+import functools
+import heapq
+import operator
+import threading
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import ahocorasick  # Optional (pyahocorasick), speeds up get_intent's keyword scan
+except ImportError:
+    ahocorasick = None
 
 try:
     from config import HA_URL, HA_TOKEN, DEFAULT_ENTITIES
@@ -12,11 +29,26 @@ except ImportError:
     print("Error: config.py not found. Please copy config.example.py to config.py and update with your settings.")
     sys.exit(1)
 
+# The entity index is written by reload_entities, so read it with the same trie format
+from reload_entities import TRIE_IDS_KEY, create_entity_index
+
 HEADERS = {
     "Authorization": f"Bearer {HA_TOKEN}",
     "content-type": "application/json",
 }
 
+MAX_PARALLEL_REQUESTS = 8  # Max concurrent service calls for multi-entity commands, also the connection pool size
+
+# Shared session so API calls reuse pooled keep-alive connections to Home Assistant
+_SESSION = requests.Session()
+_SESSION.headers.update(HEADERS)
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=MAX_PARALLEL_REQUESTS))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=MAX_PARALLEL_REQUESTS))
+
+# Certificate checks are skipped for service calls, which only means anything over HTTPS
+_IS_HTTPS = HA_URL.startswith('https')
+_SERVICE_CALL_KWARGS = {"verify": False} if _IS_HTTPS else {}
+
 # Hardcoded for performance
 MEDIA_COMMANDS = {
     "play": "media_play",
@@ -55,8 +87,73 @@ FAN_SPEEDS = {
 # Add to constants at top
 HVAC_MODE = "heat"  # or "cool" for AC
 
-# Global cache for entities
+COLORS = ["red", "green", "blue", "yellow", "orange", "purple", "pink", "white"]
+
+# Keywords get_intent looks for, as (keyword, category, value). Within a category the
+# first entry listed wins, matching the order of the checks they replace.
+INTENT_KEYWORDS = [
+    *((word, "query", None) for word in ["status", "state", "query"]),
+    ("fan", "fan", None),
+    *((speed, "fan_speed", percentage) for speed, percentage in FAN_SPEEDS.items()),
+    *((color_name, "color", color_name) for color_name in COLORS),
+    *((word, "volume", None) for word in ["volume", "vol"]),
+    *((word, "volume_up", None) for word in ["up", "increase", "raise", "higher"]),
+    *((word, "volume_down", None) for word in ["down", "decrease", "lower"]),
+    ("play", "play", None),
+    *((cmd_word, "media", service_name) for cmd_word, service_name in MEDIA_COMMANDS.items()
+      if cmd_word not in ["on", "off", "volume up", "volume down", "status"]),
+    *((phrase, "brightness", intent_val) for phrase, intent_val in BRIGHTNESS_PHRASES.items()),
+    ("on", "on", None),
+    ("off", "off", None),
+]
+
+# Precompiled patterns used on every command
+_RE_NUMBER = re.compile(r'(\d+)')
+_RE_SPLIT = re.compile(r' and |, ')
+_RE_VOLUME = re.compile(r'volume (\d+)')
+
+# Keyword patterns for classifying a command in one scan each. Plain alternations,
+# so like the substring checks they replace they also match inside longer words.
+_RE_TEMP_KEYWORDS = re.compile(r'heat|heater|thermostat|ac|air conditioner|air con')
+_RE_LIGHT_KEYWORDS = re.compile(r'%|bright|dim|color|red|blue|green|yellow|white')
+_RE_VOLUME_KEYWORDS = re.compile(r'volume|vol')
+_RE_MEDIA_KEYWORDS = re.compile(r'play|pause|next|previous|prev|stop')
+_RE_FAN_SPEED_KEYWORDS = re.compile('|'.join(map(re.escape, FAN_SPEEDS)))
+
+# keyword -> [(category, priority, value)], a keyword can belong to several categories
+_INTENT_KEYWORD_ENTRIES = {}
+for priority, (keyword, category, value) in enumerate(INTENT_KEYWORDS):
+    _INTENT_KEYWORD_ENTRIES.setdefault(keyword, []).append((category, priority, value))
+
+# Aho-Corasick automaton finding every keyword in a single pass over the command
+_INTENT_AUTOMATON = None
+if ahocorasick is not None:
+    _INTENT_AUTOMATON = ahocorasick.Automaton()
+    for keyword, entries in _INTENT_KEYWORD_ENTRIES.items():
+        _INTENT_AUTOMATON.add_word(keyword, entries)
+    _INTENT_AUTOMATON.make_automaton()
+
+# Global cache for entities. The parsed dict is kept as-is and also split into
+# parallel per-field lists (structure of arrays) so the hot path never has to
+# walk the dict, split entity_ids or lowercase names.
 _ENTITIES_CACHE = None
+_ENTITIES_CACHE_LOCK = threading.Lock()  # execute_command may lazily load the cache from worker threads
+_ENTITIES_VERSION = None  # entities_version() when _ENTITIES_CACHE was loaded
+_NAMES = None  # Entity names (cache keys), parallel to _ENTITIES_CACHE
+_NAMES_LOWER = None  # Lowercased entity names, parallel to _ENTITIES_CACHE
+_NAMES_PROCESSED = None  # process_name-normalized entity names, parallel to _ENTITIES_CACHE
+_ENTITY_IDS = None  # entity_ids, parallel to _ENTITIES_CACHE
+_DOMAINS = None  # NumPy array of entity domains, parallel to _ENTITIES_CACHE
+_DOMAIN_BY_ENTITY_ID = None  # entity_id -> domain, as stored by reload_entities
+_POSITIONS_BY_ENTITY_ID = None  # entity_id -> position in the parallel lists above
+_POSITIONS_BY_DOMAIN = None  # domain -> positions of its entities, in cache order
+_DOMAIN_CODES = None  # int8 DOMAIN_* code per entity, parallel to _ENTITIES_CACHE
+_PREFERRED_DOMAINS = None  # bool per entity, True if in PREFERRED_QUERY_DOMAINS_FOR_SHORT_AMBIGUOUS_COMMANDS
+_ENTITY_INDEX = None  # Character trie of name words -> entity_ids, written by reload_entities
+ENTITIES_FILE = 'entities.yaml'
+ENTITIES_PICKLE_FILE = 'entities.pkl'  # Parsed copy of ENTITIES_FILE, much faster to load than YAML
+ENTITY_INDEX_FILE = 'entities_index.pkl'
+_LATIN1_TABLE = dict.fromkeys(range(128, 256))  # str.translate table deleting code points 128-255
 
 # Domain categories for default intent determination
 QUERY_DOMAINS = [
@@ -85,221 +182,430 @@ SHORT_CMD_WORD_THRESHOLD = 1 # Max words in a device_name to be considered "shor
 AMBIGUOUS_DOMAIN_BONUS = 30  # Score bonus for preferred domains in ambiguous short commands (used by find_entities).
 AMBIGUOUS_MATCH_THRESHOLD = 70 # Minimum score for an entity to be considered a candidate in ambiguous short commands (used by find_entities).
 BASE_MATCH_THRESHOLD = 50    # Default minimum score for an entity to be considered a match (used by find_entities).
+# Command kinds and domain codes passed to apply_bonuses; domains not listed are DOMAIN_OTHER
+COMMAND_OTHER, COMMAND_TEMP, COMMAND_MEDIA, COMMAND_FAN, COMMAND_LIGHT = range(5)
+DOMAIN_OTHER, DOMAIN_CLIMATE, DOMAIN_MEDIA_PLAYER, DOMAIN_FAN, DOMAIN_LIGHT, DOMAIN_GROUP, DOMAIN_SWITCH = range(7)
+DOMAIN_CODES = {
+    "climate": DOMAIN_CLIMATE,
+    "media_player": DOMAIN_MEDIA_PLAYER,
+    "fan": DOMAIN_FAN,
+    "light": DOMAIN_LIGHT,
+    "group": DOMAIN_GROUP,
+    "switch": DOMAIN_SWITCH,
+}
+# Domains boosted by each command kind's bonus, always scored alongside the prefiltered candidates
+BONUS_DOMAINS = {
+    COMMAND_OTHER: ("light", "switch"),
+    COMMAND_MEDIA: ("media_player",),
+    COMMAND_FAN: ("fan",),
+    COMMAND_LIGHT: ("light",),
+}
 COMPETITIVE_SCORE_RATIO = 0.85 # Used in __main__ ambiguity resolution: a preferred domain entity is chosen if its score
                                # is at least this ratio of the top overall score.
 
-# Define the debug state file path using absolute path to script directory
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-DEBUG = False  # Default state
-DEBUG_FILE = os.path.join(SCRIPT_DIR, '.debug_state')
+# Debug is read from the FUZZY_DEBUG environment variable so startup doesn't touch the disk.
+# `debug on/off` records the choice in DEBUG_FILE for a shell alias to export, e.g.
+#   alias fuzzy='FUZZY_DEBUG=$(cat ~/.config/fuzzy_assistant/debug 2>/dev/null) python3 script.py'
+DEBUG_FILE = os.path.join(os.path.expanduser('~'), '.config', 'fuzzy_assistant', 'debug')
 
-def debug_print(*args, **kwargs):
-    """Print debug messages only if DEBUG is True"""
-    if DEBUG:
-        print("Debug -", *args, **kwargs)
+def _print_debug(*args, **kwargs):
+    print("Debug -", *args, **kwargs)
+
+def _skip_debug(*args, **kwargs):
+    pass
+
+def set_debug(enabled: bool):
+    """Set DEBUG and point debug_print at a real print or a no-op"""
+    global DEBUG, debug_print
+    DEBUG = enabled
+    debug_print = _print_debug if enabled else _skip_debug
+
+set_debug(os.environ.get('FUZZY_DEBUG', '0') == '1')
+
+def saved_debug_state() -> bool:
+    """Debug state last saved to DEBUG_FILE, or the current DEBUG if nothing was saved yet"""
+    try:
+        with open(DEBUG_FILE, 'r') as f:
+            return f.read().strip() == '1'
+    except OSError:
+        return DEBUG
 
 def toggle_debug(command=None):
     """Toggle or set debug state"""
-    global DEBUG
-    
     if command == "on":
-        DEBUG = True
+        set_debug(True)
     elif command == "off":
-        DEBUG = False
-    else:  # Toggle if no specific command
-        DEBUG = not DEBUG
+        set_debug(False)
+    else:  # Toggle if no specific command. Flip the saved state, since FUZZY_DEBUG
+           # is unset when script.py is run directly (e.g. from Alfred)
+        set_debug(not saved_debug_state())
     
+    os.makedirs(os.path.dirname(DEBUG_FILE), exist_ok=True)
     with open(DEBUG_FILE, 'w') as f:
-        f.write(str(DEBUG))
+        f.write('1' if DEBUG else '0')
     
     if DEBUG: 
         print(f"Debug ON")
     return True
-    
-def load_debug_state():
-    """Load debug state from file"""
-    global DEBUG
+
+def load_pickle_if_fresh(path):
+    """Load a pickle written by reload_entities, or None if it is missing or older than entities.yaml"""
     try:
-        with open(DEBUG_FILE, 'r') as f:
-            DEBUG = f.read().strip().lower() == 'true'
-    except FileNotFoundError:
-        pass 
+        if os.path.getmtime(path) >= os.path.getmtime(ENTITIES_FILE):
+            with open(path, 'rb') as file:
+                return pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    return None
+
+def load_entity_index(entities):
+    """Load the word trie saved by reload_entities, rebuilding it if missing or stale"""
+    entity_index = load_pickle_if_fresh(ENTITY_INDEX_FILE)
+    if entity_index is not None:
+        return entity_index
+    debug_print(f"{ENTITY_INDEX_FILE} missing or stale, building index in memory")
+    return create_entity_index(entities)
+
+def process_name(text: str) -> str:
+    """Normalize text for the token scorers like thefuzz's full_process(force_ascii=True) did,
+    dropping code points 128-255 (e.g. "ü", "é") before default_process"""
+    return default_process(text.translate(_LATIN1_TABLE))
+
+def build_entities_cache(entities, entity_index):
+    """Populate the global cache and the lookups derived from it"""
+    global _ENTITIES_CACHE, _NAMES, _NAMES_LOWER, _NAMES_PROCESSED, _ENTITY_IDS, _DOMAINS, _DOMAIN_BY_ENTITY_ID, _POSITIONS_BY_ENTITY_ID, _POSITIONS_BY_DOMAIN, _DOMAIN_CODES, _PREFERRED_DOMAINS, _ENTITY_INDEX
+    _ENTITIES_CACHE = entities
+    _NAMES = list(entities)
+    _NAMES_LOWER = [name.lower() for name in _NAMES]
+    _NAMES_PROCESSED = [process_name(name) for name in _NAMES_LOWER]
+    _ENTITY_IDS = [data['entity_id'] for data in entities.values()]
+    domains = [data['domain'] for data in entities.values()]
+    _DOMAINS = np.array(domains, dtype=str)
+    _DOMAIN_BY_ENTITY_ID = dict(zip(_ENTITY_IDS, domains))
+    _DOMAIN_CODES = np.array([DOMAIN_CODES.get(domain, DOMAIN_OTHER) for domain in domains], dtype=np.int8)
+    _PREFERRED_DOMAINS = np.isin(_DOMAINS, PREFERRED_QUERY_DOMAINS_FOR_SHORT_AMBIGUOUS_COMMANDS)
+    _POSITIONS_BY_ENTITY_ID = {entity_id: position for position, entity_id in enumerate(_ENTITY_IDS)}
+    _POSITIONS_BY_DOMAIN = {}
+    for position, domain in enumerate(domains):
+        _POSITIONS_BY_DOMAIN.setdefault(domain, []).append(position)
+    _ENTITY_INDEX = entity_index
+
+def load_entities_cache():
+    """Load entities into the global cache and precompute the scoring choices.
+    Reads the pickled copy when it is up to date, falling back to parsing entities.yaml."""
+    global _ENTITIES_VERSION
+    _ENTITIES_VERSION = entities_version()
+    entities = load_pickle_if_fresh(ENTITIES_PICKLE_FILE)
+    if entities is None:
+        debug_print(f"{ENTITIES_PICKLE_FILE} missing or stale, parsing {ENTITIES_FILE}")
+        with open(ENTITIES_FILE, 'r') as file:
+            entities = yaml.load(file, Loader=SafeLoader)
+    build_entities_cache(entities, load_entity_index(entities))
+
+def entity_domain(entity_id: str) -> str:
+    """Domain of an entity, read from the cache when possible instead of splitting the entity_id"""
+    domain = _DOMAIN_BY_ENTITY_ID.get(entity_id) if _DOMAIN_BY_ENTITY_ID else None
+    return domain if domain is not None else entity_id.split('.')[0]
+
+def entity_ids_with_prefix(prefix: str) -> set[str]:
+    """Collect the entity_ids of every indexed word starting with prefix"""
+    node = _ENTITY_INDEX
+    for char in prefix:
+        node = node.get(char)
+        if node is None:
+            return set()
+
+    entity_ids = set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        for key, child in node.items():
+            if key == TRIE_IDS_KEY:
+                entity_ids.update(child)
+            else:
+                stack.append(child)
+    return entity_ids
+
+def candidate_positions(device_name_part: str, command_kind: int) -> list[int]:
+    """Positions of entities with a name word starting with one of the words of device_name_part
+    or a name containing device_name_part, plus every entity of the domains the command kind boosts,
+    since those can win on the bonus alone.
+    Falls back to every entity when a word starts no name word: it may be a typo of the entity the
+    command means, which only the fuzzy scorers can find."""
+    all_positions = list(range(len(_NAMES_LOWER)))
+    positions = set()
+    for token in device_name_part.split():
+        entity_ids = entity_ids_with_prefix(token)
+        if not entity_ids:
+            return all_positions
+        for entity_id in entity_ids:
+            if entity_id in _POSITIONS_BY_ENTITY_ID:
+                positions.add(_POSITIONS_BY_ENTITY_ID[entity_id])
+    # The trie only finds word prefixes, so "room" needs this pass to reach "bedroom light"
+    positions.update(i for i, name_lower in enumerate(_NAMES_LOWER) if device_name_part in name_lower)
+    if not positions:
+        return all_positions
+    for domain in BONUS_DOMAINS.get(command_kind, ()):
+        positions.update(_POSITIONS_BY_DOMAIN.get(domain, []))
+    return sorted(positions)
+
+def score_candidates(device_name_part, positions, command_kind, ambiguous):
+    """Fuzzy score device_name_part against the entities at positions and apply the bonuses"""
+    if len(positions) == len(_NAMES_LOWER):
+        choices_lower, choices_processed = _NAMES_LOWER, _NAMES_PROCESSED
+    else:
+        choices_lower = [_NAMES_LOWER[i] for i in positions]
+        choices_processed = [_NAMES_PROCESSED[i] for i in positions]
+
+    # Score the part against every candidate name at once. np.round rounds half to even like the
+    # Python round() thefuzz used; an integer dtype would round half up and shift some scores.
+    # Token scorers compare pre-normalized strings so process_name runs once per part, not per pair.
+    dnp_proc = process_name(device_name_part)
+    score_set     = process.cdist([dnp_proc], choices_processed, scorer=fuzz.token_set_ratio, processor=None, dtype=np.float64, workers=-1)[0]
+    score_sort    = process.cdist([dnp_proc], choices_processed, scorer=fuzz.token_sort_ratio, processor=None, dtype=np.float64, workers=-1)[0]
+    score_partial = process.cdist([device_name_part], choices_lower, scorer=fuzz.partial_ratio, dtype=np.float64, workers=-1)[0]
+    combined_scores = (np.round(score_set) + np.round(score_sort) + np.round(score_partial)) / 3
+
+    # Apply the substring and domain bonuses to all candidates at once
+    positions = list(positions)
+    substring_hits = np.fromiter((device_name_part in name_lower for name_lower in choices_lower), dtype=bool, count=len(choices_lower))
+    return apply_bonuses(combined_scores, _DOMAIN_CODES[positions], _PREFERRED_DOMAINS[positions],
+                         substring_hits, command_kind, ambiguous)
+
+def apply_bonuses(scores, domain_codes, preferred, substring_hits, command_kind, ambiguous):
+    """Add the substring and domain bonuses to the fuzzy scores of one device name part"""
+    scores = scores + 10 * substring_hits
+    if ambiguous:
+        scores[preferred] += AMBIGUOUS_DOMAIN_BONUS
+
+    if command_kind == COMMAND_TEMP:
+        scores = np.where(domain_codes == DOMAIN_CLIMATE, scores + 200, 0)
+    elif command_kind == COMMAND_MEDIA:
+        scores += np.where(domain_codes == DOMAIN_MEDIA_PLAYER, 100, -50)
+    elif command_kind == COMMAND_FAN:
+        scores += np.where(domain_codes == DOMAIN_FAN, 100, -50)
+    elif command_kind == COMMAND_LIGHT:
+        scores[domain_codes == DOMAIN_LIGHT] += 60
+        scores[domain_codes == DOMAIN_GROUP] -= 40
+    else:
+        scores[(domain_codes == DOMAIN_LIGHT) | (domain_codes == DOMAIN_SWITCH)] += 40
+    return scores
+
+def _apply_bonuses_loop(scores, domain_codes, preferred, substring_hits, command_kind, ambiguous):
+    """Single pass equivalent of apply_bonuses, compiled by enable_numba"""
+    out = scores.copy()
+    for i in range(out.shape[0]):
+        score = out[i]
+        if substring_hits[i]:
+            score += 10
+        if ambiguous and preferred[i]:
+            score += AMBIGUOUS_DOMAIN_BONUS
+
+        code = domain_codes[i]
+        if command_kind == COMMAND_TEMP:
+            score = score + 200 if code == DOMAIN_CLIMATE else 0.0
+        elif command_kind == COMMAND_MEDIA:
+            score += 100 if code == DOMAIN_MEDIA_PLAYER else -50
+        elif command_kind == COMMAND_FAN:
+            score += 100 if code == DOMAIN_FAN else -50
+        elif command_kind == COMMAND_LIGHT:
+            if code == DOMAIN_LIGHT:
+                score += 60
+            elif code == DOMAIN_GROUP:
+                score -= 40
+        elif code == DOMAIN_LIGHT or code == DOMAIN_SWITCH:
+            score += 40
+        out[i] = score
+    return out
+
+def enable_numba() -> bool:
+    """Swap apply_bonuses for a Numba-compiled loop. Only worth it in a long running process
+    like server.py, which pays the import and compile cost once. False if numba isn't installed."""
+    global apply_bonuses
+    try:
+        import numba
+    except ImportError:
+        return False
+    apply_bonuses = numba.njit(cache=True, fastmath=True)(_apply_bonuses_loop)
+    return True
 
-def find_entities(user_input: str) -> list[tuple[float, str]] | None:
-    start_time = time.time()
-    global _ENTITIES_CACHE
-    
+def entities_version() -> float | None:
+    """Modification time of entities.yaml, used to invalidate cached lookups when it changes"""
     try:
-        user_input_lower = user_input.lower()
-        
-        # Check if the command starts with a default entity key
-        for key in DEFAULT_ENTITIES:
-            if user_input_lower.startswith(key):
-                entity_id = DEFAULT_ENTITIES[key]
-                debug_print(f"Using default entity for '{key}': {entity_id}")
-                if isinstance(entity_id, str):
-                    return [(100.0, entity_id)]
-                elif isinstance(entity_id, list):
-                    return [(100.0, eid) for eid in entity_id]
-
-        colors = ["red", "green", "blue", "yellow", "orange", "purple", "pink", "white"]
-        if user_input_lower in colors:
-            debug_print(f"Using default color lights")
-            return [(100.0, eid) for eid in DEFAULT_ENTITIES.get('color_lights', [])]
-            
-        debug_print(f"Automations will be included in search if names match.")
-        
-        is_temp_command = bool(re.search(r'(\d+)', user_input_lower) and 
-                             any(word in user_input_lower for word in [
-                                 'heat', 'heater', 'thermostat', 
-                                 'ac', 'air conditioner', 'air con'
-                             ]))
-        
-        if _ENTITIES_CACHE is None:
-            cache_start = time.time()
-            with open('entities.yaml', 'r') as file:
-                _ENTITIES_CACHE = yaml.safe_load(file)
-            debug_print(f"Cache load time: {(time.time() - cache_start)*1000:.1f}ms")
+        return os.path.getmtime(ENTITIES_FILE)
+    except OSError:
+        return None
+
+@functools.lru_cache(maxsize=512)
+def _find_entities_impl(user_input_lower: str, version: float | None) -> tuple[tuple[float, str], ...]:
+    """Memoized core of find_entities. Returns hashable tuples so repeated commands are answered
+    from the cache; version is entities_version(), part of the key so a reload invalidates old
+    results. find_entities bypasses the cache while debugging so the diagnostics always print."""
+    # Check if the command starts with a default entity key
+    for key in DEFAULT_ENTITIES:
+        if user_input_lower.startswith(key):
+            entity_id = DEFAULT_ENTITIES[key]
+            debug_print(f"Using default entity for '{key}': {entity_id}")
+            if isinstance(entity_id, str):
+                return ((100.0, entity_id),)
+            elif isinstance(entity_id, list):
+                return tuple((100.0, eid) for eid in entity_id)
+
+    if user_input_lower in COLORS:
+        debug_print(f"Using default color lights")
+        return tuple((100.0, eid) for eid in DEFAULT_ENTITIES.get('color_lights', []))
         
-        device_names = re.split(r' and |, ', user_input_lower)
-        found_entities_with_scores = []
+    debug_print(f"Automations will be included in search if names match.")
+    
+    is_temp_command = bool(_RE_NUMBER.search(user_input_lower) and _RE_TEMP_KEYWORDS.search(user_input_lower))
+    
+    if _ENTITIES_CACHE is None or _ENTITIES_VERSION != version:
+        cache_start = time.time()
+        load_entities_cache()
+        debug_print(f"Cache load time: {(time.time() - cache_start)*1000:.1f}ms")
+    
+    device_names = _RE_SPLIT.split(user_input_lower)
+    found_entities_with_scores = []
 
-        is_short_ambiguous_input_context = (
-            len(device_names) == 1 and 
-            len(device_names[0].split()) <= SHORT_CMD_WORD_THRESHOLD
-        )
-        if is_short_ambiguous_input_context:
-            debug_print(f"Short ambiguous input context detected for: '{user_input}'")
+    is_short_ambiguous_input_context = (
+        len(device_names) == 1 and 
+        len(device_names[0].split()) <= SHORT_CMD_WORD_THRESHOLD
+    )
+    if is_short_ambiguous_input_context:
+        debug_print(f"Short ambiguous input context detected for: '{user_input_lower}'")
+
+    for device_name_part in device_names: 
+        device_name_part = device_name_part.strip()
+        if not device_name_part: 
+            continue
+
+        is_light_command = bool(_RE_LIGHT_KEYWORDS.search(device_name_part))
+        is_volume_command = bool(_RE_VOLUME_KEYWORDS.search(device_name_part))
+        is_media_command = bool(_RE_MEDIA_KEYWORDS.search(device_name_part)) or is_volume_command
+        is_fan_command = "fan" in device_name_part and bool(_RE_FAN_SPEED_KEYWORDS.search(device_name_part))
+
+        if is_temp_command: command_kind = COMMAND_TEMP
+        elif is_media_command: command_kind = COMMAND_MEDIA
+        elif is_fan_command: command_kind = COMMAND_FAN
+        elif is_light_command: command_kind = COMMAND_LIGHT
+        else: command_kind = COMMAND_OTHER
+
+        all_positions = range(len(_NAMES_LOWER))
+        if is_temp_command:
+            # Every other domain scores 0 for temperature commands, so only climate entities are worth scoring
+            positions = _POSITIONS_BY_DOMAIN.get('climate', [])
+        elif is_short_ambiguous_input_context:
+            # Every entity above AMBIGUOUS_MATCH_THRESHOLD is a candidate for the preferred domain
+            # tie-break in run_command, including ones that share no word with the input
+            positions = all_positions
+        else:
+            positions = candidate_positions(device_name_part, command_kind)
+        debug_print(f"Scoring {len(positions)} of {len(_NAMES_LOWER)} entities for '{device_name_part}'")
+        combined_scores = score_candidates(device_name_part, positions, command_kind, is_short_ambiguous_input_context)
 
-        for device_name_part in device_names: 
-            device_name_part = device_name_part.strip()
-            if not device_name_part: 
-                continue
+        if len(positions) < len(_NAMES_LOWER) and not is_temp_command and \
+                (combined_scores.size == 0 or combined_scores.max() <= BASE_MATCH_THRESHOLD):
+            # An entity outside the prefiltered candidates may still pass the threshold through its fuzzy score
+            debug_print(f"No prefiltered match above {BASE_MATCH_THRESHOLD} for '{device_name_part}', scoring every entity")
+            positions = all_positions
+            combined_scores = score_candidates(device_name_part, positions, command_kind, is_short_ambiguous_input_context)
 
-            potential_matches_for_part = []
-            
-            is_light_command = any(word in device_name_part for word in ['%', 'bright', 'dim', 'color', 'red', 'blue', 'green', 'yellow', 'white'])
-            is_volume_command = any(word in device_name_part for word in ['volume', 'vol'])
-            is_media_command = any(word in device_name_part for word in ['play', 'pause', 'next', 'previous', 'prev', 'stop']) or is_volume_command
-            is_fan_command = "fan" in device_name_part and any(speed in device_name_part for speed in FAN_SPEEDS.keys())
-
-            for name, data in _ENTITIES_CACHE.items():
-                entity_id = data['entity_id']
-                entity_domain = entity_id.split('.')[0]
-                name_lower = name.lower()
-                
-                if is_temp_command and not entity_id.startswith('climate.'):
-                    continue
-                
-                score_set    = fuzz.token_set_ratio(device_name_part, name_lower)
-                score_sort   = fuzz.token_sort_ratio(device_name_part, name_lower)
-                score_partial = fuzz.partial_ratio(device_name_part, name_lower)
-                combined_score = (score_set + score_sort + score_partial) / 3
-
-                if device_name_part in name_lower: 
-                    combined_score += 10
-
-                if is_short_ambiguous_input_context and entity_domain in PREFERRED_QUERY_DOMAINS_FOR_SHORT_AMBIGUOUS_COMMANDS:
-                    combined_score += AMBIGUOUS_DOMAIN_BONUS
-                    debug_print(f"Applied domain bonus for {entity_id} (domain: {entity_domain}). New score: {combined_score:.0f} (was {(combined_score - AMBIGUOUS_DOMAIN_BONUS):.0f})")
-
-                if is_temp_command: 
-                    if entity_domain == 'climate': combined_score += 200
-                    else: combined_score = 0 
-                elif is_media_command:
-                    if entity_domain == 'media_player': combined_score += 100
-                    else: combined_score -= 50
-                elif is_fan_command:
-                    if entity_domain == 'fan': combined_score += 100
-                    else: combined_score -= 50
-                elif is_light_command:
-                    if entity_domain == 'light': combined_score += 60
-                    elif entity_domain == 'group': combined_score -= 40 
-                elif not any([is_light_command, is_media_command, is_fan_command, is_temp_command]):
-                    if entity_domain in ['light', 'switch']: 
-                        combined_score += 40
-
-                if combined_score > 0: 
-                    potential_matches_for_part.append((combined_score, entity_id))
-            
-            if not potential_matches_for_part:
-                continue
-
-            potential_matches_for_part.sort(key=lambda x: x[0], reverse=True)
-            debug_print(f"Potential matches for '{device_name_part}': {potential_matches_for_part[:5]}") 
-
-            if is_short_ambiguous_input_context:
-                for score, entity_id in potential_matches_for_part:
-                    if score >= AMBIGUOUS_MATCH_THRESHOLD:
-                        if not any(e_id == entity_id for _, e_id in found_entities_with_scores):
-                             found_entities_with_scores.append((score, entity_id))
-                             debug_print(f"Adding candidate for short ambiguous input: {entity_id} (Score: {score:.0f})")
-                    else:
-                        break 
-            else:
-                if potential_matches_for_part: 
-                    best_score_for_part, best_match_for_part = potential_matches_for_part[0]
-                    if best_score_for_part > BASE_MATCH_THRESHOLD:
-                        if not any(e_id == best_match_for_part for _, e_id in found_entities_with_scores):
-                            found_entities_with_scores.append((best_score_for_part, best_match_for_part))
-                            debug_print(f"Best match for part '{device_name_part}': {best_match_for_part} (Score: {best_score_for_part:.0f})")
-        
-        found_entities_with_scores.sort(key=lambda x: x[0], reverse=True)
-        
-        debug_print(f"Entity finding time: {(time.time() - start_time)*1000:.1f}ms. Found: {found_entities_with_scores}")
-        return found_entities_with_scores if found_entities_with_scores else None
+        matched = np.flatnonzero(combined_scores > 0)
+        if matched.size == 0:
+            continue
+
+        if DEBUG:
+            head = heapq.nlargest(5, matched, key=combined_scores.__getitem__)
+            debug_print(f"Potential matches for '{device_name_part}': {[(float(combined_scores[i]), _ENTITY_IDS[positions[i]]) for i in head]}") 
+
+        if is_short_ambiguous_input_context:
+            # Added in entity order; the stable sort below ranks them, so no per-part sort is needed
+            for i in np.flatnonzero(combined_scores >= AMBIGUOUS_MATCH_THRESHOLD):
+                score, entity_id = float(combined_scores[i]), _ENTITY_IDS[positions[i]]
+                if not any(e_id == entity_id for _, e_id in found_entities_with_scores):
+                     found_entities_with_scores.append((score, entity_id))
+                     debug_print(f"Adding candidate for short ambiguous input: {entity_id} (Score: {score:.0f})")
+        else:
+            best = np.argmax(combined_scores) # First of equal scores, like the stable sort it replaces
+            best_score_for_part, best_match_for_part = float(combined_scores[best]), _ENTITY_IDS[positions[best]]
+            if best_score_for_part > BASE_MATCH_THRESHOLD:
+                if not any(e_id == best_match_for_part for _, e_id in found_entities_with_scores):
+                    found_entities_with_scores.append((best_score_for_part, best_match_for_part))
+                    debug_print(f"Best match for part '{device_name_part}': {best_match_for_part} (Score: {best_score_for_part:.0f})")
+    
+    found_entities_with_scores.sort(key=operator.itemgetter(0), reverse=True)
+    return tuple(found_entities_with_scores)
+
+def find_entities(user_input: str) -> list[tuple[float, str]] | None:
+    start_time = time.time()
+    
+    try:
+        # Skip the memo while debugging so the match diagnostics print for repeated commands too
+        find = _find_entities_impl.__wrapped__ if DEBUG else _find_entities_impl
+        found_entities_with_scores = list(find(user_input.lower(), entities_version()))
     except FileNotFoundError:
         print("Debug - entities.yaml file not found!")
         return None
 
+    debug_print(f"Entity finding time: {(time.time() - start_time)*1000:.1f}ms. Found: {found_entities_with_scores}")
+    return found_entities_with_scores if found_entities_with_scores else None
+
+def find_intent_keywords(command: str) -> dict[str, tuple[int, object]]:
+    """Map each keyword category present in command to its highest priority (priority, value).
+    Keywords match anywhere in the command, including inside longer words."""
+    if _INTENT_AUTOMATON is not None:
+        matches = (entries for _, entries in _INTENT_AUTOMATON.iter(command))
+    else:
+        matches = (entries for keyword, entries in _INTENT_KEYWORD_ENTRIES.items() if keyword in command)
+
+    found = {}
+    for entries in matches:
+        for category, priority, value in entries:
+            if category not in found or priority < found[category][0]:
+                found[category] = (priority, value)
+    return found
+
 def get_intent(command: str, primary_entity_domain: str | None = None) -> str | tuple | None:
     command = command.lower().strip()
+    found = find_intent_keywords(command)
 
-    if any(keyword in command for keyword in ["status", "state", "query"]):
+    if "query" in found:
         return "query_state"
 
     if "trigger" in command.split(): 
         return "trigger_entity"
 
-    if "fan" in command:
-        for speed, percentage in FAN_SPEEDS.items():
-            if speed in command:
-                return ("fan_speed", percentage)
+    if "fan" in found and "fan_speed" in found:
+        return ("fan_speed", found["fan_speed"][1])
 
-    colors = ["red", "green", "blue", "yellow", "orange", "purple", "pink", "white"]
-    for color_name in colors: 
-        if color_name in command:
-            return ("color", color_name)
+    if "color" in found:
+        return ("color", found["color"][1])
 
-    number_match = re.search(r'(\d+)', command)
+    number_match = _RE_NUMBER.search(command)
     if number_match:
         number = float(number_match.group(1))
         return ("number", number)
 
-    volume_words = ["volume", "vol"]
-    if any(word in command for word in volume_words):
-        if "up" in command or "increase" in command or "raise" in command or "higher" in command:
+    if "volume" in found:
+        if "volume_up" in found:
             return "volume_up"
-        elif "down" in command or "decrease" in command or "lower" in command:
+        elif "volume_down" in found:
             return "volume_down"
-        elif volume_match := re.search(r'volume (\d+)', command): 
+        elif volume_match := _RE_VOLUME.search(command): 
             return ("volume_set", float(volume_match.group(1)) / 100)
 
-    if "play" in command: 
+    if "play" in found: 
         return "media_play"
-    for cmd_word, service_name in MEDIA_COMMANDS.items():
-        if cmd_word in command:
-            if cmd_word not in ["on", "off", "volume up", "volume down", "status"]: 
-                return service_name 
+    if "media" in found:
+        return found["media"][1]
 
-    for phrase, intent_val in BRIGHTNESS_PHRASES.items():
-        if phrase in command:
-            return intent_val 
+    if "brightness" in found:
+        return found["brightness"][1]
 
-    if "on" in command:
+    if "on" in found:
         return "turn_on"
 
-    if "off" in command:
+    if "off" in found:
         return "turn_off"
             
     if command: 
@@ -327,13 +633,20 @@ def get_intent(command: str, primary_entity_domain: str | None = None) -> str |
     debug_print("Command exhausted all specific checks, falling back to 'toggle'.")
     return "toggle"
 
+def prewarm_connection():
+    """Resolve HA_URL and open a pooled keep-alive connection ahead of the first command.
+    Used by server.py; on failure the first command simply connects as it would have anyway."""
+    try:
+        _SESSION.head(HA_URL, timeout=2, **_SERVICE_CALL_KWARGS)
+    except requests.exceptions.RequestException as e:
+        debug_print(f"Could not prewarm connection to {HA_URL}: {e}")
+
 def get_device_state(entity_id):
     """Get the current state of a device.
     Returns the state string in lowercase on success, None on failure."""
     try:
-        response = requests.get(
+        response = _SESSION.get(
             f"{HA_URL}/api/states/{entity_id}",
-            headers=HEADERS,
             timeout=5 
         )
         response.raise_for_status() 
@@ -362,9 +675,8 @@ def get_device_state(entity_id):
 
 def get_group_entities(group_entity_id: str) -> list[str]:
     """Get all entities that belong to a group"""
-    response = requests.get(
-        f"{HA_URL}/api/states/{group_entity_id}",
-        headers=HEADERS
+    response = _SESSION.get(
+        f"{HA_URL}/api/states/{group_entity_id}"
     )
     if response.status_code == 200:
         state_data = response.json()
@@ -375,26 +687,21 @@ def execute_command(entity_id: str, intent: str | tuple) -> bool:
     start_time = time.time()
     transition = 0 
 
-    global _ENTITIES_CACHE 
-    if _ENTITIES_CACHE is None: 
-        try:
-            with open('entities.yaml', 'r') as file:
-                _ENTITIES_CACHE = yaml.safe_load(file)
-            debug_print("Cache loaded in execute_command")
-        except FileNotFoundError:
-            debug_print("entities.yaml not found in execute_command, friendly names might not be available.")
-            _ENTITIES_CACHE = {} 
+    with _ENTITIES_CACHE_LOCK:
+        if _ENTITIES_CACHE is None: 
+            try:
+                load_entities_cache()
+                debug_print("Cache loaded in execute_command")
+            except FileNotFoundError:
+                debug_print("entities.yaml not found in execute_command, friendly names might not be available.")
+                build_entities_cache({}, {})
 
     if intent == "status": 
         get_device_state(entity_id) 
         return True
     elif intent == "query_state":
-        friendly_name = entity_id 
-        if _ENTITIES_CACHE: 
-            for name, data_val in _ENTITIES_CACHE.items(): 
-                if data_val.get('entity_id') == entity_id:
-                    friendly_name = name
-                    break
+        position = _POSITIONS_BY_ENTITY_ID.get(entity_id)
+        friendly_name = _NAMES[position] if position is not None else entity_id
         
         state_value_or_status = get_device_state(entity_id)
         
@@ -410,7 +717,7 @@ def execute_command(entity_id: str, intent: str | tuple) -> bool:
             
         return True 
 
-    domain = entity_id.split('.')[0]
+    domain = entity_domain(entity_id)
     data = { "entity_id": entity_id }
     service = None 
 
@@ -479,35 +786,35 @@ def execute_command(entity_id: str, intent: str | tuple) -> bool:
     debug_print(f"With data: {data}")
 
     try:
-        response = requests.post(url, headers=HEADERS, json=data, timeout=1, verify=False)
+        response = _SESSION.post(url, json=data, timeout=1, **_SERVICE_CALL_KWARGS)
         debug_print(f"Command execution time: {(time.time() - start_time)*1000:.1f}ms")
         return response.status_code == 200
     except Exception as e:
         # print(f"Error: {e}")
         return False
 
-if __name__ == "__main__":
+def run_command(command: str) -> int:
+    """Run one command end to end and return the process exit status.
+    Shared by the command line entry point and server.py."""
     # --- Main script execution flow ---
+    global _ENTITIES_CACHE
     start_time = time.time()
-    load_debug_state() 
-    
-    if len(sys.argv) < 2:
-        sys.exit(1)
     
-    command = " ".join(sys.argv[1:]).lower().strip()
+    command = command.lower().strip()
     
     if command == "reload":
         try:
             import reload_entities 
             reload_entities.main()
+            _ENTITIES_CACHE = None # Pick up the new files on the next command
             print("Entities reloaded successfully")
-            sys.exit(0) 
+            return 0 
         except ImportError:
             print("Error: reload_entities.py not found. Cannot reload entities.")
-            sys.exit(1)
+            return 1
         except Exception as e:
             print(f"Failed to reload entities: {e}")
-            sys.exit(1)
+            return 1
     
     if command == "debug" or command.startswith("debug "):
         parts = command.split()
@@ -515,13 +822,13 @@ if __name__ == "__main__":
             toggle_debug(parts[1])  
         else:
             toggle_debug()  
-        sys.exit(0) 
+        return 0 
     
     found_entities_with_scores = find_entities(command)
 
     if not found_entities_with_scores:
         print("No matching devices found") 
-        sys.exit(1) 
+        return 1 
     
     entity_ids_for_processing = []
     chosen_entity_id_for_intent = found_entities_with_scores[0][1] # Default to top match for primary domain
@@ -538,7 +845,7 @@ if __name__ == "__main__":
         highest_preferred_score = 0
 
         for r_score, r_eid in found_entities_with_scores:
-            r_domain = r_eid.split('.')[0]
+            r_domain = entity_domain(r_eid)
             if r_domain in PREFERRED_QUERY_DOMAINS_FOR_SHORT_AMBIGUOUS_COMMANDS:
                 if r_score >= top_score * COMPETITIVE_SCORE_RATIO:
                     if r_score > highest_preferred_score:
@@ -561,7 +868,7 @@ if __name__ == "__main__":
 
     primary_domain = None 
     if entity_ids_for_processing: # Should always have at least one item if we reached here
-        primary_domain = chosen_entity_id_for_intent.split('.')[0]
+        primary_domain = entity_domain(chosen_entity_id_for_intent)
         debug_print(f"Primary entity domain for intent determination: {primary_domain} (from {chosen_entity_id_for_intent})")
     
     intent = get_intent(command, primary_entity_domain=primary_domain) 
@@ -575,14 +882,30 @@ if __name__ == "__main__":
              debug_print(f"No default action for automation '{entity_display_name}'. Command not executed.")
         else: 
              debug_print(f"Intent resolved to None for '{entity_display_name}'. Command not executed.")
+    elif len(entity_ids_for_processing) == 1: 
+        success = execute_command(entity_ids_for_processing[0], intent)
+    elif intent == "query_state":
+        # Queries print each state as they go, so run them one by one to keep the command's order
+        success = all([execute_command(entity_id, intent) for entity_id in entity_ids_for_processing])
     elif entity_ids_for_processing: 
-        for entity_id in entity_ids_for_processing:
-            if not execute_command(entity_id, intent):
-                success = False
-                # print(f"Failed for {entity_id}") 
+        # Service calls are network bound, so send them to Home Assistant concurrently
+        with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_REQUESTS, len(entity_ids_for_processing))) as executor:
+            results = list(executor.map(lambda entity_id: execute_command(entity_id, intent), entity_ids_for_processing))
+        success = all(results)
     
     if not success:
         print("") 
     
     if DEBUG:
         debug_print(f"Total execution time: {(time.time() - start_time)*1000:.1f}ms")
+
+    return 0
+
+def main():
+    """Command line entry point"""
+    if len(sys.argv) < 2:
+        sys.exit(1)
+    sys.exit(run_command(" ".join(sys.argv[1:])))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import contextlib
+import io
+import os
+import socketserver
+import sys
+
+import script
+from client import SOCKET_PATH, send_command
+
+# Long running server for client.py. Keeps script.py imported and the entity
+# cache loaded so each command skips interpreter start-up, imports and loading.
+# Run it from the same folder you would run script.py from.
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    """Runs one command per connection and replies with the exit status line followed by the output"""
+
+    def handle(self):
+        command = self.rfile.readline().decode('utf-8').strip()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            try:
+                status = script.run_command(command) if command else 1
+            except Exception as e:
+                print(f"Error: {e}")
+                status = 1
+        self.wfile.write(f"{status}\n{output.getvalue()}".encode('utf-8'))
+
+def main():
+    """Start serving commands on SOCKET_PATH"""
+    try:
+        send_command("")
+    except (FileNotFoundError, ConnectionRefusedError):
+        # Nothing is listening, so a socket left here is from a previous run and would make bind() fail
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(SOCKET_PATH)
+    else:
+        print(f"A server is already listening on {SOCKET_PATH}")
+        sys.exit(1)
+
+    if script.enable_numba():
+        print("Using Numba-compiled scoring")
+    try:
+        script.load_entities_cache()
+    except FileNotFoundError:
+        print("entities.yaml not found, run 'python script.py reload' first.")
+    script.prewarm_connection()
+
+    # Create the socket as owner-only right away, it may live in a shared temp dir
+    old_umask = os.umask(0o177)
+    try:
+        # Commands are handled one at a time since redirect_stdout is process wide
+        server = socketserver.UnixStreamServer(SOCKET_PATH, CommandHandler)
+    finally:
+        os.umask(old_umask)
+
+    with server:
+        print(f"Listening on {SOCKET_PATH}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(SOCKET_PATH)
+
+if __name__ == "__main__":
+    main()